@@ -1,88 +1,252 @@
 import streamlit as st
-import tempfile
+import asyncio
+import base64
+import concurrent.futures
+import hashlib
+import io
+import mimetypes
 import os
+import re
+import threading
 from pathlib import Path
-from mistralai import Mistral
-from mistralai import DocumentURLChunk, ImageURLChunk, TextChunk # TextChunk not used in this snippet but good to keep if Mistral changes
-from mistralai.models import OCRResponse
-import json # Not explicitly used in this snippet, can be removed if not needed elsewhere
+from typing import Iterator, NamedTuple
+from mistralai import Mistral, DocumentURLChunk, ImageURLChunk
+from mistralai.models import OCRResponse, SDKError
 from dotenv import load_dotenv
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 
 # Load environment variables from .env file (local development)
 load_dotenv()
 
-# Get API key from environment variables (works for both local and cloud deployment)
-api_key = os.getenv('MISTRAL_API_KEY')
-if not api_key:
-    st.error("""
-        Missing MISTRAL_API_KEY in environment variables. 
-        Local users: Please check your .env file
-        Cloud deployment: Ensure you've set up the secret in Streamlit Cloud
-    """)
-    st.stop()
+@st.cache_resource
+def get_client() -> Mistral:
+    """Create the Mistral client once per process so its connection pools are reused across reruns."""
+    # Get API key from environment variables (works for both local and cloud deployment)
+    api_key = os.getenv('MISTRAL_API_KEY')
+    if not api_key:
+        st.error("""
+            Missing MISTRAL_API_KEY in environment variables. 
+            Local users: Please check your .env file
+            Cloud deployment: Ensure you've set up the secret in Streamlit Cloud
+        """)
+        st.stop()
 
-# Initialize Mistral client
-client = Mistral(api_key=api_key)
+    return Mistral(api_key=api_key)
+
+# Upper bound on one upload + OCR round-trip, retries included
+PIPELINE_TIMEOUT_SECONDS = 600
+
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Start a long-lived event loop in a background thread.
+    This loop exists only so that every conversion shares the cached client's
+    one async connection pool. That pool is bound to the loop that opened it,
+    so a fresh asyncio.run() per conversion would break it.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+# Builds the OCR document chunk for each supported file type from its signed URL
+CHUNK_FACTORY = {
+    'pdf': lambda url: DocumentURLChunk(document_url=url),
+    'image': lambda url: ImageURLChunk(image_url=url),
+}
+
+# HTTP statuses worth retrying; anything else (auth, validation) fails fast
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def is_transient_error(exc: BaseException) -> bool:
+    """Return True for Mistral API errors caused by rate limiting or upstream overload."""
+    return isinstance(exc, SDKError) and exc.status_code in RETRYABLE_STATUS_CODES
+
+# Retry policy shared by every Mistral API call
+api_retry = retry(
+    retry=retry_if_exception(is_transient_error),
+    wait=wait_random_exponential(min=1, max=16),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+
+# Mistral marks image positions as `![id](id)`; compiled once and shared by every page
+IMAGE_PLACEHOLDER_RE = re.compile(r"!\[([^\]]+)\]\(\1\)")
+
+# A placeholder that is the only thing on its line, so it can be drawn as a block of its own
+STANDALONE_PLACEHOLDER_RE = re.compile(r"^!\[([^\]]+)\]\(\1\)[ \t]*$", re.MULTILINE)
 
 def replace_images_in_markdown(markdown_str: str, images_dict: dict) -> str:
     """Replace image placeholders with base64 encoded images in markdown."""
-    for img_name, base64_str in images_dict.items():
-        markdown_str = markdown_str.replace(f"![{img_name}]({img_name})", f"![{img_name}]({base64_str})")
-    return markdown_str
+    if not images_dict:
+        return markdown_str
 
-def get_combined_markdown(ocr_response: OCRResponse) -> str:
-    """Combine markdown from all pages with their respective images."""
-    markdowns: list[str] = []
+    # Copy the text between placeholders once into a single buffer; ids without an image are left untouched
+    buf = io.StringIO()
+    last = 0
+    for m in IMAGE_PLACEHOLDER_RE.finditer(markdown_str):
+        buf.write(markdown_str[last:m.start()])
+        img_id = m.group(1)
+        buf.write(f"![{img_id}]({images_dict.get(img_id, img_id)})")
+        last = m.end()
+    buf.write(markdown_str[last:])
+    return buf.getvalue()
+
+def decode_image(image_base64: str) -> bytes:
+    """Decode a base64 image, with or without a `data:` URI prefix, to raw bytes."""
+    if image_base64.startswith("data:"):
+        image_base64 = image_base64.partition(",")[2]
+    return base64.b64decode(image_base64)
+
+def image_data_uri(img_id: str, image_bytes: bytes) -> str:
+    """Encode image bytes as a base64 data URI, guessing the MIME type from the image id."""
+    mime_type = mimetypes.guess_type(img_id)[0] or "image/jpeg"
+    return f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('ascii')}"
+
+def embed_images(markdown_str: str, images_dict: dict) -> str:
+    """Inline the images referenced by markdown_str as data URIs, encoding only those."""
+    image_uris = {
+        img_id: image_data_uri(img_id, images_dict[img_id])
+        for img_id in IMAGE_PLACEHOLDER_RE.findall(markdown_str)
+        if img_id in images_dict
+    }
+    return replace_images_in_markdown(markdown_str, image_uris)
+
+class OCRPage(NamedTuple):
+    """Markdown of one OCR page and its decoded images, keyed by image id."""
+    markdown: str
+    images: dict
+
+def iter_page_markdown(ocr_response: OCRResponse, include_images: bool) -> Iterator[OCRPage]:
+    """
+    Yield each page's markdown and its images. Placeholders are left in place
+    when images are included and removed otherwise, since they would only
+    render as broken links.
+    """
     for page in ocr_response.pages:
+        if not include_images:
+            yield OCRPage(IMAGE_PLACEHOLDER_RE.sub("", page.markdown), {})
+            continue
+
         image_data = {}
-        for img in page.images:
-            image_data[img.id] = img.image_base64
-        markdowns.append(replace_images_in_markdown(page.markdown, image_data))
+        if page.images:
+            # Only keep images the page actually references; orphaned crops are dropped
+            images_by_id = {img.id: img for img in page.images}
+            for img_id in IMAGE_PLACEHOLDER_RE.findall(page.markdown):
+                if img_id in images_by_id:
+                    # Decode once here, inside the cached result, so reruns never decode again
+                    image_data[img_id] = decode_image(images_by_id[img_id].image_base64)
+        yield OCRPage(page.markdown, image_data)
+
+def get_combined_markdown(pages: list[OCRPage]) -> str:
+    """Combine markdown from all pages with their respective images."""
+    return "\n\n".join(embed_images(page.markdown, page.images) for page in pages)
 
-    return "\n\n".join(markdowns)
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_download_markdown(file_digest: str, file_type_for_api: str, include_images: bool, _pages: list[OCRPage]) -> str:
+    """Build the self-contained download once per converted file rather than on every rerun."""
+    return get_combined_markdown(_pages)
 
-def process_file_to_markdown(file_path: str, file_type_for_api: str) -> str:
+def render_markdown_with_images(page: OCRPage) -> None:
+    """Render a page's markdown, drawing images with st.image rather than inlining base64 into the text."""
+    if not page.images:
+        st.markdown(page.markdown)
+        return
+
+    # Only placeholders on their own line become separate st.image blocks;
+    # re.split keeps the captured image ids at the odd indices
+    parts = STANDALONE_PLACEHOLDER_RE.split(page.markdown)
+    for i, part in enumerate(parts):
+        if i % 2 and part in page.images:
+            st.image(page.images[part], caption=part)
+            continue
+        if i % 2:
+            part = f"![{part}]({part})"
+        # Splitting inside a paragraph, list or table would break it apart, so inline those images
+        part = embed_images(part, page.images)
+        if part.strip():
+            st.markdown(part)
+
+@api_retry
+async def upload_file(client: Mistral, file_bytes: bytes, file_stem: str):
+    """Upload file content to Mistral for OCR."""
+    return await client.files.upload_async(
+        file={
+            "file_name": file_stem, # Use stem of the original file for Mistral's reference
+            "content": file_bytes,
+        },
+        purpose="ocr",
+    )
+
+async def run_ocr_pipeline(client: Mistral, file_bytes: bytes, file_stem: str, file_type_for_api: str, include_images: bool) -> OCRResponse:
     """
-    Convert PDF or image file to Markdown using Mistral OCR API
+    Upload a single file and run OCR on it using the async Mistral API.
+    The three calls depend on each other and run one after another; the async
+    API is used only so they go through the shared loop's connection pool.
     Args:
-        file_path (str): Path to the temporary file
+        client (Mistral): Mistral client to issue the requests with
+        file_bytes (bytes): Content of the file
+        file_stem (str): Original file name without its extension
         file_type_for_api (str): Type of file for API call ('pdf' or 'image')
+        include_images (bool): Whether to request embedded images from the API
     Returns:
-        str: Converted markdown text
+        OCRResponse: Raw OCR response from Mistral
     """
+    # Upload file to Mistral
+    uploaded_file_mistral = await upload_file(client, file_bytes, file_stem)
+
+    # Get signed URL
+    signed_url = await api_retry(client.files.get_signed_url_async)(file_id=uploaded_file_mistral.id, expiry=1) # Short expiry as it's used immediately
+
+    # Process the file with OCR
+    return await api_retry(client.ocr.process_async)(
+        document=CHUNK_FACTORY[file_type_for_api](signed_url.url),
+        model="mistral-ocr-latest",
+        include_image_base64=include_images
+    )
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def ocr_file_to_markdown(file_digest: str, _file_bytes: bytes, _file_stem: str, file_type_for_api: str, include_images: bool) -> list[OCRPage]:
+    """
+    Run the Mistral OCR pipeline, memoized on the file's content digest.
+    Exceptions propagate so that failed conversions are never cached.
+    Args:
+        file_digest (str): Content hash of the file, used as the cache key
+        _file_bytes (bytes): Content of the file
+        _file_stem (str): Original file name without its extension
+        file_type_for_api (str): Type of file for API call ('pdf' or 'image')
+        include_images (bool): Whether to request embedded images from the API
+    Returns:
+        list[OCRPage]: Markdown and decoded images of each page
+    """
+    # Resolve the client on the script thread, then run the requests on the shared loop
+    client = get_client()
+    future = asyncio.run_coroutine_threadsafe(
+        run_ocr_pipeline(client, _file_bytes, _file_stem, file_type_for_api, include_images),
+        get_event_loop(),
+    )
     try:
-        # Convert string path to Path object
-        file = Path(file_path)
-        
-        # Upload file to Mistral
-        uploaded_file_mistral = client.files.upload(
-            file={
-                "file_name": file.stem, # Use stem of the temp file for Mistral's reference
-                "content": file.read_bytes(),
-            },
-            purpose="ocr",
-        )
+        response = future.result(timeout=PIPELINE_TIMEOUT_SECONDS)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise TimeoutError(f"OCR did not finish within {PIPELINE_TIMEOUT_SECONDS} seconds") from None
 
-        # Get signed URL
-        signed_url = client.files.get_signed_url(file_id=uploaded_file_mistral.id, expiry=1) # Short expiry as it's used immediately
-
-        # Process the file with OCR
-        if file_type_for_api == 'pdf':
-            response = client.ocr.process(
-                document=DocumentURLChunk(document_url=signed_url.url),
-                model="mistral-ocr-latest",
-                include_image_base64=True
-            )
-        else:  # image
-            response = client.ocr.process(
-                document=ImageURLChunk(image_url=signed_url.url),
-                model="mistral-ocr-latest",
-                include_image_base64=True
-            )
-
-        # Convert to markdown
-        markdown_text = get_combined_markdown(response)
-        return markdown_text
+    # Split into per-page markdown and images
+    return list(iter_page_markdown(response, include_images))
+
+def process_file_to_markdown(file_digest: str, file_bytes: bytes, file_stem: str, file_type_for_api: str, include_images: bool) -> list[OCRPage]:
+    """
+    Convert PDF or image file to Markdown using Mistral OCR API
+    Args:
+        file_digest (str): Content hash of the file, used as the cache key
+        file_bytes (bytes): Content of the file
+        file_stem (str): Original file name without its extension
+        file_type_for_api (str): Type of file for API call ('pdf' or 'image')
+        include_images (bool): Whether to request embedded images from the API
+    Returns:
+        list[OCRPage]: Markdown and decoded images of each page
+    """
+    try:
+        return ocr_file_to_markdown(file_digest, file_bytes, file_stem, file_type_for_api, include_images)
 
     except Exception as e:
         st.error(f"Error in file conversion: {str(e)}")
@@ -92,6 +256,9 @@ def main():
     st.title("Document to Markdown Converter")
     st.write("Convert a PDF, image file, or camera capture to Markdown format.")
 
+    # Fail fast on a missing API key before asking for any input
+    get_client()
+
     # Input method selector
     input_method = st.radio(
         "Choose an input method:",
@@ -100,6 +267,13 @@ def main():
         key="input_method_selector"
     )
 
+    # Base64 images inflate the OCR response considerably, so they are opt-in
+    include_images = st.checkbox(
+        "Include embedded images (larger output)",
+        value=False,
+        key="include_images"
+    )
+
     uploaded_file_streamlit = None  # To store the file object from Streamlit uploader/camera
     file_type_for_processing = None # This will be 'pdf' or 'image' for process_file_to_markdown
 
@@ -127,51 +301,46 @@ def main():
             file_type_for_processing = 'image' # Camera always produces an image
 
     if uploaded_file_streamlit is not None and file_type_for_processing is not None:
-        # Determine file extension for temp file
         original_file_name = uploaded_file_streamlit.name # e.g., "my_doc.pdf" or "camera_input.png"
-        file_extension = Path(original_file_name).suffix
-
-        # Robust fallback for extension if name doesn't have one
-        if not file_extension:
-            if uploaded_file_streamlit.type == "application/pdf":
-                file_extension = ".pdf"
-            elif uploaded_file_streamlit.type == "image/png":
-                file_extension = ".png"
-            elif uploaded_file_streamlit.type == "image/jpeg":
-                file_extension = ".jpg"
-            elif uploaded_file_streamlit.type == "image/bmp":
-                file_extension = ".bmp"
-            elif uploaded_file_streamlit.type == "image/tiff":
-                file_extension = ".tiff"
-            else: 
-                st.warning(f"Could not reliably determine file extension for {original_file_name} (type: {uploaded_file_streamlit.type}). Using '.tmp'.")
-                file_extension = ".tmp" # Generic extension if all else fails
-        
-        # Create a temporary file to store the uploaded content
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as tmp_file:
-            tmp_file.write(uploaded_file_streamlit.getvalue())
-            tmp_file_path = tmp_file.name
+        file_stem = Path(original_file_name).stem
+
+        # Read the upload once; the same bytes are hashed and sent to Mistral
+        file_bytes = uploaded_file_streamlit.getvalue()
+
+        # Hash the content once; identical uploads reuse the cached conversion
+        file_digest = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
 
         try:
             with st.spinner('Converting to Markdown...'):
                 # Convert file to Markdown
-                markdown_text = process_file_to_markdown(
-                    tmp_file_path,
-                    file_type_for_processing 
+                pages = process_file_to_markdown(
+                    file_digest,
+                    file_bytes,
+                    file_stem,
+                    file_type_for_processing,
+                    include_images
                 )
 
+            # Placeholder form of the whole document; empty when OCR found no text
+            markdown_text = "\n\n".join(page.markdown for page in pages).strip() if pages else ""
+
             if markdown_text:
                 st.subheader("Converted Markdown:")
-                st.markdown(markdown_text)
-                
-                st.subheader("Raw Markdown:")
-                st.text_area("Raw Markdown Output", markdown_text, height=300)
+                # One collapsible block per page lets the browser lay out pages incrementally
+                for i, page in enumerate(pages):
+                    with st.expander(f"Page {i + 1}", expanded=i < 2):
+                        render_markdown_with_images(page)
+
+                # The raw view echoes the whole document, so only send it when asked for
+                if st.checkbox("Show raw Markdown", key="show_raw_markdown"):
+                    st.subheader("Raw Markdown:")
+                    st.text_area("Raw Markdown Output", markdown_text, height=300)
 
-                # Add a download button for the markdown
-                download_file_name = f"{Path(original_file_name).stem}_converted.md"
+                # Add a download button for the markdown, with images embedded
+                download_file_name = f"{file_stem}_converted.md"
                 st.download_button(
                     label="Download Markdown",
-                    data=markdown_text,
+                    data=build_download_markdown(file_digest, file_type_for_processing, include_images, pages),
                     file_name=download_file_name,
                     mime="text/markdown"
                 )
@@ -181,9 +350,5 @@ def main():
         except Exception as e:
             st.error(f"An error occurred: {str(e)}")
 
-        finally:
-            # Clean up the temporary file
-            os.unlink(tmp_file_path)
-
 if __name__ == "__main__":
     main()
\ No newline at end of file